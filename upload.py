@@ -5,12 +5,18 @@ import argparse
 import requests
 import time
 import threading
+import queue
 import subprocess
-import random
-import string
+import secrets
 import hashlib
+import json
+import fcntl
 from dotenv import load_dotenv
-from urllib.parse import quote_plus
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import quote_plus, urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from email.utils import parsedate_to_datetime
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from pydrive2.auth import GoogleAuth
 from pydrive2.drive import GoogleDrive
@@ -35,47 +41,87 @@ TIKTOK_TOKEN_URL = os.getenv("TIKTOK_TOKEN_URL", "https://open.tiktokapis.com/v2
 TIKTOK_UPLOAD_INIT_URL = os.getenv("TIKTOK_UPLOAD_INIT_URL", "https://open.tiktokapis.com/v2/post/publish/inbox/video/init/")
 # Video Status endpoint for polling
 TIKTOK_VIDEO_STATUS_URL = os.getenv("TIKTOK_VIDEO_STATUS_URL", "https://open.tiktokapis.com/v2/post/publish/inbox/video/status/")
+# Where access/refresh tokens are cached between runs
+TOKEN_CACHE_PATH = os.path.expanduser(os.getenv("TIKTOK_TOKEN_CACHE_PATH", "~/.tiktok_uploader_token.json"))
+# Treat tokens as expired this many seconds early
+TOKEN_EXPIRY_MARGIN = 60
+# Manifest of uploaded videos, used to skip them on later runs
+MANIFEST_PATH = os.path.abspath(os.getenv("UPLOAD_MANIFEST_PATH", "processed.json"))
 
-# Constants for file handling and transcription
+# Constants for file handling and uploads
 TRANSCRIPT_EXTENSION = ".txt"
-WHISPER_MODEL = "whisper-1"
-CHATGPT_MODEL = "gpt-3.5-turbo"
+UPLOAD_CHUNK_SIZE = 1 << 20  # 1 MiB reads per socket write when streaming videos
+UPLOAD_PREFETCH_CHUNKS = 4  # chunks read ahead of the socket while uploading
+# Concurrent uploads; TikTok rejects inits once too many shares are pending
+MAX_WORKERS = 4
+
+# Shared HTTP session so token exchange, init, upload and status polling reuse
+# pooled keep-alive connections to the TikTok hosts instead of a new TLS
+# handshake per request. Each host's pool holds one connection per upload worker,
+# so concurrent init/status calls each keep a warm connection. Only urllib3's
+# default idempotent methods (GET status polls, the video PUT) are retried on
+# 429/5xx; POSTs are not, since repeating an init call can create duplicate
+# posts. raise_on_status=False returns the final response so the existing
+# status-code handling still applies after retries are exhausted.
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=MAX_WORKERS,
+    max_retries=Retry(total=3, backoff_factor=0.5,
+                      status_forcelist=(429, 500, 502, 503, 504),
+                      raise_on_status=False)
+))
 
 # PKCE Utility Functions
+# Verifier and state come from the CSPRNG; token_urlsafe only emits characters
+# from the PKCE unreserved set, and each byte yields ~1.3 characters, so
+# `length` bytes is always enough to slice from.
 def generate_code_verifier(length=64):
-    allowed = string.ascii_letters + string.digits + "-._~"
-    return ''.join(random.choice(allowed) for _ in range(length))
+    return secrets.token_urlsafe(length)[:length]
 
+# TikTok's desktop Login Kit expects the hex-encoded SHA-256 of the verifier
+# rather than RFC 7636's base64url form, so keep hexdigest here.
 def generate_code_challenge(code_verifier):
     return hashlib.sha256(code_verifier.encode('utf-8')).hexdigest()
 
 def generate_state(length=16):
-    allowed = string.ascii_letters + string.digits
-    return ''.join(random.choice(allowed) for _ in range(length))
+    return secrets.token_urlsafe(length)[:length]
 
-# OAuth Callback Server using Flask
-from flask import Flask, request
+# OAuth Callback Server using the standard library
 auth_code_global = None
-app = Flask(__name__)
+# Set by the callback so get_auth_code_default wakes as soon as the redirect lands.
+auth_event = threading.Event()
+AUTH_TIMEOUT_SECONDS = 300
 
-@app.route('/callback')
-def callback():
-    global auth_code_global
-    auth_code_global = request.args.get("code")
-    return "Authentication successful. You can close this window."
+class CallbackHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        global auth_code_global
+        parsed = urlparse(self.path)
+        if parsed.path != "/callback":
+            self.send_response(404)
+            self.end_headers()
+            return
+        auth_code_global = parse_qs(parsed.query).get("code", [None])[0]
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.end_headers()
+        self.wfile.write(b"Authentication successful. You can close this window.")
+        auth_event.set()
 
-def run_flask_server():
-    app.run(host="localhost", port=8000, debug=False, use_reloader=False)
+    def log_message(self, format, *args):
+        pass
 
 def get_auth_code_default():
     global auth_code_global
     auth_code_global = None
+    auth_event.clear()
     code_verifier = generate_code_verifier()
     code_challenge = generate_code_challenge(code_verifier)
     state = generate_state()
-    flask_thread = threading.Thread(target=run_flask_server)
-    flask_thread.daemon = True
-    flask_thread.start()
+    server = HTTPServer(("localhost", 8000), CallbackHandler)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
     encoded_redirect_uri = quote_plus(REDIRECT_URI)
     auth_url = (
         f"https://www.tiktok.com/v2/auth/authorize/?"
@@ -86,8 +132,13 @@ def get_auth_code_default():
     print("OAuth URL being opened:", auth_url)
     print("Opening Safari for TikTok authentication...")
     subprocess.call(["open", "-a", "Safari", auth_url])
-    while auth_code_global is None:
-        time.sleep(1)
+    try:
+        if not auth_event.wait(timeout=AUTH_TIMEOUT_SECONDS):
+            print("Timed out waiting for the TikTok authentication callback.")
+    finally:
+        # Stop the callback server so port 8000 is free for a retry.
+        server.shutdown()
+        server.server_close()
     return auth_code_global, code_verifier
 
 def exchange_code_for_token(code, code_verifier):
@@ -99,13 +150,14 @@ def exchange_code_for_token(code, code_verifier):
         "grant_type": "authorization_code",
         "code_verifier": code_verifier
     }
-    response = requests.post(TIKTOK_TOKEN_URL, data=payload)
+    response = SESSION.post(TIKTOK_TOKEN_URL, data=payload)
     if response.status_code == 200:
         data = response.json()
         print(f"Token exchange response: {data}")
         access_token = data.get("access_token")
         if access_token:
             print("Access token obtained.")
+            save_token(data)
             return access_token
         else:
             print("Error: No access token returned.")
@@ -114,7 +166,68 @@ def exchange_code_for_token(code, code_verifier):
         print("Error exchanging code for token:", response.text)
         return None
 
+# Token Cache
+# Tokens are persisted with 0600 permissions so later runs can reuse a valid
+# access token, or refresh it, instead of repeating the browser-based OAuth flow.
+def save_token(data):
+    now = time.time()
+    token = {
+        "access_token": data.get("access_token"),
+        "refresh_token": data.get("refresh_token"),
+        "expires_at": now + data.get("expires_in", 0),
+        "refresh_expires_at": now + data["refresh_expires_in"] if "refresh_expires_in" in data else None
+    }
+    tmp_path = TOKEN_CACHE_PATH + ".tmp"
+    try:
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(token, f)
+        os.replace(tmp_path, TOKEN_CACHE_PATH)
+    except OSError as e:
+        print(f"Error saving TikTok token cache: {e}")
+
+def load_token():
+    try:
+        with open(TOKEN_CACHE_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def refresh_access_token(refresh_token):
+    payload = {
+        "client_key": TIKTOK_CLIENT_ID,
+        "client_secret": TIKTOK_CLIENT_SECRET,
+        "grant_type": "refresh_token",
+        "refresh_token": refresh_token
+    }
+    print("Refreshing TikTok access token...")
+    response = SESSION.post(TIKTOK_TOKEN_URL, data=payload)
+    if response.status_code == 200:
+        data = response.json()
+        access_token = data.get("access_token")
+        if access_token:
+            print("Access token refreshed.")
+            save_token(data)
+            return access_token
+        else:
+            print("Error: No access token returned from refresh:", data)
+            return None
+    else:
+        print("Error refreshing access token:", response.text)
+        return None
+
 def get_tiktok_access_token():
+    token = load_token()
+    if token:
+        now = time.time()
+        if token.get("access_token") and token.get("expires_at", 0) - now > TOKEN_EXPIRY_MARGIN:
+            print("Using cached TikTok access token.")
+            return token["access_token"]
+        refresh_expires_at = token.get("refresh_expires_at")
+        if token.get("refresh_token") and (refresh_expires_at is None or refresh_expires_at - now > TOKEN_EXPIRY_MARGIN):
+            access_token = refresh_access_token(token["refresh_token"])
+            if access_token:
+                return access_token
     code, code_verifier = get_auth_code_default()
     if not code:
         print("Failed to retrieve auth code.")
@@ -140,11 +253,12 @@ def initialize_video_post(file_size, access_token, caption):
         }
     }
     print("Initializing video post...")
-    response = requests.post(TIKTOK_UPLOAD_INIT_URL, headers=headers, json=payload)
+    response = SESSION.post(TIKTOK_UPLOAD_INIT_URL, headers=headers, json=payload)
     if response.status_code == 200:
-        data = response.json().get("data", {})
-        if "error" in response.json():
-            error = response.json()["error"]
+        body = response.json()
+        data = body.get("data", {})
+        if "error" in body:
+            error = body["error"]
             if error.get("code") == "spam_risk_too_many_pending_share":
                 print("Rate limit reached: Too many pending shares.")
                 return "RATE_LIMIT", None
@@ -157,25 +271,87 @@ def initialize_video_post(file_size, access_token, caption):
             return publish_id, upload_url
         else:
             print("Error: Missing publish_id or upload_url in init response.")
-            print("Response:", response.json())
+            print("Response:", body)
             return None, None
     else:
         print("Error initializing video post:", response.text)
         return None, None
 
+# Streams a file in large chunks so the upload never holds the whole video in
+# memory. Exposing __len__ lets requests send Content-Length instead of falling
+# back to chunked transfer encoding. A background thread reads a few chunks ahead
+# so the disk read of the next chunk overlaps with sending the current one.
+# Each iteration reads with os.pread from its own offset and stops any earlier
+# iteration's reader first: a failed PUT's generator can outlive the request via
+# the exception traceback, and a retried PUT must resend the full body in order.
+class FileChunks:
+    def __init__(self, file_obj, size, chunk_size=UPLOAD_CHUNK_SIZE, prefetch=UPLOAD_PREFETCH_CHUNKS):
+        self.file_obj = file_obj
+        self.size = size
+        self.chunk_size = chunk_size
+        self.prefetch = prefetch
+        self.active_stop = None
+        self.active_producer = None
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        if self.active_producer is not None:
+            self.active_stop.set()
+            self.active_producer.join()
+        chunks = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        fd = self.file_obj.fileno()
+
+        # Returns False once the consumer has gone away (e.g. the PUT failed).
+        def put(item):
+            while not stop.is_set():
+                try:
+                    chunks.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            offset = 0
+            try:
+                while not stop.is_set():
+                    chunk = os.pread(fd, self.chunk_size, offset)
+                    offset += len(chunk)
+                    if not put(chunk) or not chunk:
+                        return
+            except Exception as e:
+                put(e)
+
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+        self.active_stop, self.active_producer = stop, producer
+        try:
+            while True:
+                chunk = chunks.get()
+                if isinstance(chunk, Exception):
+                    raise chunk
+                if not chunk:
+                    return
+                yield chunk
+        finally:
+            stop.set()
+            producer.join()
+
 # Direct Post: Upload Call (using PUT with required headers including Content-Range)
 def upload_video_file(upload_url, video_path, caption):
     print("Uploading video file via Direct Post...")
     file_size = os.path.getsize(video_path)
-    with open(video_path, "rb") as video_file:
-        file_data = video_file.read()
     headers = {
         "Content-Type": "video/mp4",
         "Content-Length": str(file_size),
         "Content-Range": f"bytes 0-{file_size - 1}/{file_size}",
         "Accept": "application/json"
     }
-    response = requests.put(upload_url, headers=headers, data=file_data)
+    with open(video_path, "rb") as video_file:
+        response = SESSION.put(upload_url, headers=headers, data=FileChunks(video_file, file_size))
     if response.status_code in (200, 201):
         print("Direct post upload successful.")
         return True
@@ -185,11 +361,33 @@ def upload_video_file(upload_url, video_path, caption):
         return False
 
 # Poll Video Status
+# Polls with exponential backoff (0.5s growing 1.5x up to 10s) so quick encodes
+# return promptly while slow ones aren't polled every few seconds. A Retry-After
+# header from TikTok takes precedence over the computed delay.
+POLL_INITIAL_DELAY = 0.5
+POLL_MAX_DELAY = 10.0
+POLL_BACKOFF_FACTOR = 1.5
+
+def get_retry_after(response):
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
 def poll_video_status(publish_id, access_token):
     headers = {"Authorization": f"Bearer {access_token}"}
     params = {"publish_id": publish_id}
+    delay = POLL_INITIAL_DELAY
     while True:
-        response = requests.get(TIKTOK_VIDEO_STATUS_URL, headers=headers, params=params)
+        response = SESSION.get(TIKTOK_VIDEO_STATUS_URL, headers=headers, params=params)
         if response.status_code == 200:
             data = response.json().get("data", {})
             status = data.get("status")
@@ -201,10 +399,60 @@ def poll_video_status(publish_id, access_token):
             return "COMPLETED"
         else:
             print("Error polling video status:", response.text)
-        time.sleep(5)
+        retry_after = get_retry_after(response)
+        time.sleep(retry_after if retry_after is not None else min(delay, POLL_MAX_DELAY))
+        delay *= POLL_BACKOFF_FACTOR
+
+# Upload Manifest
+# Maps each uploaded video's SHA-256 to its publish_id plus the path, size and
+# mtime it had. Later runs load it once and skip unchanged files in memory, and
+# renamed or copied videos are caught by hash before anything is uploaded.
+# Writers serialize on a lock file and replace the manifest atomically, so
+# readers never see a partial file and concurrent runs don't drop entries.
+MANIFEST_LOCK = threading.Lock()
+# Hashes of videos being uploaded in this run, guarded by MANIFEST_LOCK
+CLAIMED_HASHES = set()
+
+def load_manifest():
+    try:
+        with open(MANIFEST_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def compute_file_hash(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def record_upload(video_sha, video_path, publish_id):
+    try:
+        with MANIFEST_LOCK, open(MANIFEST_PATH + ".lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            manifest = load_manifest()
+            stat = os.stat(video_path)
+            manifest[video_sha] = {
+                "path": video_path,
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+                "publish_id": publish_id
+            }
+            tmp_path = MANIFEST_PATH + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(manifest, f, indent=2)
+            os.replace(tmp_path, MANIFEST_PATH)
+    except OSError as e:
+        print(f"Error updating upload manifest: {e}")
+
+# Lets a later identical copy be uploaded after this one failed to publish.
+def release_claim(video_sha):
+    with MANIFEST_LOCK:
+        CLAIMED_HASHES.discard(video_sha)
 
 # Direct Post Flow
-def direct_post_video(video_path, access_token):
+def direct_post_video(video_path, access_token, manifest=None):
     file_size = os.path.getsize(video_path)
     base, _ = os.path.splitext(video_path)
     txt_file = base + TRANSCRIPT_EXTENSION
@@ -213,16 +461,37 @@ def direct_post_video(video_path, access_token):
         return None
     with open(txt_file, "r", encoding="utf-8") as f:
         caption = f.read().strip()
-    init_result = initialize_video_post(file_size, access_token, caption)
-    if not init_result or init_result[0] == "RATE_LIMIT":
-        return "RATE_LIMIT"
-    publish_id, upload_url = init_result
-    if not upload_video_file(upload_url, video_path, caption):
-        return None
-    print("Waiting for video processing to complete...")
-    final_status = poll_video_status(publish_id, access_token)
-    print("Final video status:", final_status)
-    return publish_id
+    # Hash only once the caption is known to exist; it is a full read of the video.
+    video_sha = compute_file_hash(video_path)
+    # Claim the hash before init so identical copies in the same run are skipped
+    # too, not just videos recorded by earlier runs.
+    with MANIFEST_LOCK:
+        duplicate = video_sha in CLAIMED_HASHES or bool(manifest and video_sha in manifest)
+        if not duplicate:
+            CLAIMED_HASHES.add(video_sha)
+    if duplicate:
+        print(f"Skipping {video_path}: an identical video was already uploaded.")
+        return "DUPLICATE"
+    # Release the claim unless the upload was recorded, whether this returns a
+    # failure, ends in a FAILED status, or raises, so a later copy can still post.
+    recorded = False
+    try:
+        init_result = initialize_video_post(file_size, access_token, caption)
+        if not init_result or init_result[0] == "RATE_LIMIT":
+            return "RATE_LIMIT"
+        publish_id, upload_url = init_result
+        if not upload_video_file(upload_url, video_path, caption):
+            return None
+        print("Waiting for video processing to complete...")
+        final_status = poll_video_status(publish_id, access_token)
+        print("Final video status:", final_status)
+        if final_status != "FAILED":
+            record_upload(video_sha, video_path, publish_id)
+            recorded = True
+        return publish_id
+    finally:
+        if not recorded:
+            release_claim(video_sha)
 
 def get_tiktok_publish_id(video_path, access_token):
     return direct_post_video(video_path, access_token)
@@ -255,19 +524,34 @@ def main():
         print("No .mp4 files found.")
         sys.exit(0)
 
+    # Skip videos recorded in the manifest whose path, size and mtime are unchanged.
+    manifest = load_manifest()
+    uploaded = {(e.get("path"), e.get("size"), e.get("mtime_ns")) for e in manifest.values()}
+    files_to_upload = []
+    for f in files:
+        stat = os.stat(f)
+        if (f, stat.st_size, stat.st_mtime_ns) in uploaded:
+            print(f"Skipping {f} because it is already in the upload manifest.")
+        else:
+            files_to_upload.append(f)
+    if not files_to_upload:
+        print("All files have already been uploaded.")
+        sys.exit(0)
+
     access_token = get_tiktok_access_token()
     if not access_token:
         print("TikTok authentication failed. Exiting.")
         sys.exit(1)
 
     results = []
-    with ThreadPoolExecutor(max_workers=4) as executor:
-        future_to_file = {executor.submit(direct_post_video, f, access_token): f for f in files}
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        future_to_file = {executor.submit(direct_post_video, f, access_token, manifest): f for f in files_to_upload}
         for future in as_completed(future_to_file):
             result = future.result()
             results.append((future_to_file[future], result))
 
-    success = [os.path.basename(f) for f, pub in results if pub and pub != "RATE_LIMIT"]
+    success = [os.path.basename(f) for f, pub in results if pub and pub not in ("RATE_LIMIT", "DUPLICATE")]
+    duplicates = [os.path.basename(f) for f, pub in results if pub == "DUPLICATE"]
     failures = [(os.path.basename(f), pub) for f, pub in results if pub is None or pub == "RATE_LIMIT"]
 
     print("\n--- Upload Summary ---")
@@ -277,6 +561,11 @@ def main():
         print("Files uploaded successfully:")
         for name in success:
             print(f" - {name}")
+    print(f"Skipped as duplicates: {len(duplicates)}")
+    if duplicates:
+        print("Duplicate files (identical video already uploaded):")
+        for name in duplicates:
+            print(f" - {name}")
     print(f"Failed uploads: {len(failures)}")
     if failures:
         print("Failed files:")